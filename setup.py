@@ -6,7 +6,8 @@ from src import __version__
 requires = [
     'requests==2.20.1',
     'pyserial==3.4',
-    'urllib3'
+    'urllib3',
+    'orjson'
 ]
 
 setup(
@@ -1,28 +1,59 @@
 # -*- coding: utf-8 -*-
+import array
 import logging
-from json import JSONDecodeError
-from queue import Queue, Empty
+import sys
+import time
+from collections import deque
 from threading import Event, Thread
-from typing import Union
+from typing import Callable, Union
 from urllib.parse import urljoin
 
+import orjson
 import requests
 import serial
+from orjson import JSONDecodeError, JSONEncodeError
 from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 from urllib3 import Retry
 
 from src.helpers import get_extractor, decode_bytearr, read_config
 
+if sys.platform.startswith('linux'):
+    import fcntl
+    import termios
+
 LOG = logging.getLogger(__name__)
 
+# Linux serial_struct flag (include/uapi/linux/tty_flags.h)
+_ASYNC_LOW_LATENCY = 0x2000
+
 
 class SerialListener:
-    def __init__(self, device_path: str, timeout: int = 1, config: dict = None):
+    """Read and extract lines from a serial device, handing off completed
+    batches of extracted records via the collector queue
+
+    Parameters
+    ----------
+    device_path: str
+    extractor: Callable
+        Extractor function as returned by :func:`get_extractor`
+    timeout: int
+    config: dict
+
+    """
+    batch_size = 10
+    # Maximum time (seconds) a partial batch is held before being handed off
+    max_latency = 2.0
+
+    def __init__(self, device_path: str, extractor: Callable[[str], Union[dict, None]],
+                 timeout: int = 1, config: dict = None):
         self._device = device_path
-        self._queue = Queue()
+        self._extractor = extractor
+        self._queue = deque()
         self._exiting = Event()
+        self._batch_ready = Event()
         self._buffer = bytearray()
+        self._start = 0
         self._config = dict(
             baudrate=57600,
             parity=serial.PARITY_NONE,
@@ -38,9 +69,32 @@ class SerialListener:
     def open(self):
         self._handle = serial.Serial(port=self._device, **self._config)
         LOG.info(f'Opened serial handle on {self._device}')
+        self._set_low_latency()
+
+    def _set_low_latency(self) -> bool:
+        """Set ASYNC_LOW_LATENCY on the serial port (Linux only)
+
+        USB serial adapters such as FTDI otherwise deliver bytes on their 16ms
+        latency timer. flags is the 5th int field of the kernel serial_struct.
+
+        """
+        if not sys.platform.startswith('linux'):
+            LOG.debug('Low latency mode not supported on %s', sys.platform)
+            return False
+        buf = array.array('i', [0] * 32)
+        try:
+            fcntl.ioctl(self._handle.fileno(), termios.TIOCGSERIAL, buf)
+            buf[4] |= _ASYNC_LOW_LATENCY
+            fcntl.ioctl(self._handle.fileno(), termios.TIOCSSERIAL, buf)
+        except OSError as e:
+            LOG.debug('Unable to set low latency mode on %s: %s', self._device, e)
+            return False
+        LOG.debug('Set low latency mode on %s', self._device)
+        return True
 
     def exit(self):
         self._exiting.set()
+        self._batch_ready.set()
 
     @property
     def collector(self):
@@ -50,6 +104,10 @@ class SerialListener:
     def exit_sig(self):
         return self._exiting
 
+    @property
+    def batch_ready(self):
+        return self._batch_ready
+
     def readline(self):
         """Read a line of data (terminated by \n) from the serial handle
 
@@ -59,35 +117,50 @@ class SerialListener:
         Credit for this function to skoehler (https://github.com/skoehler) from
         https://github.com/pyserial/pyserial/issues/216
 
+        Lines are sliced from the buffer at a read offset rather than
+        re-slicing the remainder of the buffer for every line.
+
         """
-        i = self._buffer.find(b"\n")
-        if i >= 0:
-            line = self._buffer[:i + 1]
-            self._buffer = self._buffer[i + 1:]
-            return line
-        while not self._exiting.is_set():
-            i = max(1, min(2048, self._handle.in_waiting))
-            data = self._handle.read(i)
+        i = self._buffer.find(b"\n", self._start)
+        while i < 0:
+            if self._exiting.is_set():
+                return b''
+            data = self._handle.read(max(1, min(2048, self._handle.in_waiting)))
             if data == b'':
                 return ''
-            i = data.find(b"\n")
-            if i >= 0:
-                line = self._buffer + data[:i + 1]
-                self._buffer[0:] = data[i + 1:]
-                return line
-            else:
-                self._buffer.extend(data)
-        return b''
+            end = len(self._buffer)
+            self._buffer += data
+            i = self._buffer.find(b"\n", end)
+
+        line = self._buffer[self._start:i + 1]
+        self._start = i + 1
+        # Consumed bytes are only discarded once the buffer is drained or the
+        # read offset has moved well into the buffer
+        if self._start == len(self._buffer) or self._start > 2048:
+            del self._buffer[:self._start]
+            self._start = 0
+        return line
 
     def listen(self):
         LOG.debug('Running Serial Listener Thread')
         if self._handle is None:
             self.open()
+        batch = []
+        deadline = time.monotonic() + self.max_latency
         while not self._exiting.is_set():
             line = decode_bytearr(self.readline())
-            if line is None or line == '':
-                continue
-            self._queue.put_nowait(line)
+            if line:
+                data = self._extractor(line)
+                if data is None:
+                    LOG.warning("Unable to extract fields from line %s", line)
+                else:
+                    if not batch:
+                        deadline = time.monotonic() + self.max_latency
+                    batch.append(data)
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._queue.append(batch)
+                self._batch_ready.set()
+                batch = []
 
 
 class HTTPSender(Thread):
@@ -95,8 +168,12 @@ class HTTPSender(Thread):
 
     Parameters
     ----------
-    queue: Queue
+    queue: deque
+        Queue of extracted record batches (lists of dicts). There is a single
+        producer and consumer, so deque append/popleft is used without locking
     exit_sig: Event
+    batch_ready: Event
+        Set by the producer when a batch has been put on the queue
     session: requests.Session
     host: str
     sensor_id: int
@@ -109,11 +186,13 @@ class HTTPSender(Thread):
               'e_temperature', 's_temperature', 'latitude', 'longitude',
               'datetime']
 
-    def __init__(self, queue: Queue, exit_sig: Event, session: requests.Session,
-                 host: str, sensor_id: int, sensor_type: str, meter_config=None):
+    def __init__(self, queue: deque, exit_sig: Event, batch_ready: Event,
+                 session: requests.Session, host: str, sensor_id: int,
+                 sensor_type: str, meter_config=None):
         super().__init__(name='HTTPSender')
         self._queue = queue
         self._exiting = exit_sig
+        self._batch_ready = batch_ready
         self.session = session
         self._uri = urljoin(host, f'/collect/{sensor_id}')
         self.sensor_type = sensor_type
@@ -121,11 +200,29 @@ class HTTPSender(Thread):
 
     def exit(self):
         self._exiting.set()
+        self._batch_ready.set()
 
-    def _send_line(self, line_json):
+    @staticmethod
+    def _drop_unencodable(records: list) -> list:
+        """Return the records which can be JSON encoded, logging any dropped
+
+        orjson rejects values such as integers wider than 64 bits, which can be
+        produced by a corrupted serial line.
+        """
+        kept = []
+        for record in records:
+            try:
+                orjson.dumps(record)
+            except JSONEncodeError as e:
+                LOG.warning('Dropping record which cannot be encoded (%s): %s', e, record)
+            else:
+                kept.append(record)
+        return kept
+
+    def _send_line(self, body: bytes):
         try:
-            response = self.session.post(self._uri, json=line_json)
-            return response.json()
+            response = self.session.post(self._uri, data=body)
+            return orjson.loads(response.content)
         except (ConnectionError, ConnectionRefusedError):
             LOG.error("Couldn't connect, exhausted max retries")
             return {'Status': 'FAIL', 'Reason': 'Max Retries Exhausted'}
@@ -133,40 +230,37 @@ class HTTPSender(Thread):
             return {'Status': 'FAIL', 'Reason': 'JSONDecodeError'}
 
     def run(self):
-        extractor = get_extractor(self.sensor_type)
-        batch = 10
         batch_queue = []
 
         while not self._exiting.is_set():
-            try:
-                line: str = self._queue.get(block=True, timeout=2)
-            except Empty:
-                LOG.debug("No data recv from queue")
-                continue
-
-            data = extractor(line, self.fields)
-            if data is None:
-                LOG.warning(f"Unable to extract fields from line {line}")
-                self._queue.task_done()
+            self._batch_ready.wait()
+            self._batch_ready.clear()
+            # Coalesce all batches queued since the last wakeup
+            while self._queue:
+                batch_queue.extend(self._queue.popleft())
+            if not batch_queue:
                 continue
 
-            batch_queue.insert(0, data)
-            self._queue.task_done()
-            if len(batch_queue) < batch:
-                continue
-
-            payload = {'data': batch_queue, 'length': len(batch_queue)}
+            try:
+                body = orjson.dumps({'data': batch_queue, 'length': len(batch_queue)})
+            except JSONEncodeError:
+                # Drop the offending records, otherwise every retry would fail
+                batch_queue = self._drop_unencodable(batch_queue)
+                if not batch_queue:
+                    continue
+                body = orjson.dumps({'data': batch_queue, 'length': len(batch_queue)})
 
             try:
-                result = self._send_line(payload)
+                result = self._send_line(body)
             except ConnectionError:
                 LOG.exception('Send failed')
                 continue
             if result.get('Status', 'FAIL') == 'OK':
-                LOG.debug(f'Sent {len(batch_queue)} lines of data')
+                if LOG.isEnabledFor(logging.DEBUG):
+                    LOG.debug('Sent %d lines of data', len(batch_queue))
+                    LOG.debug('Send Status: %s, Count: %s', result.get('Status'),
+                              result.get('Count', -1))
                 batch_queue.clear()
-                LOG.debug(f'Send Status: {result.get("Status")}, '
-                          f'Count: {result.get("Count", -1)}')
             else:
                 LOG.warning("Send line failed")
                 LOG.warning(result)
@@ -176,10 +270,17 @@ class HTTPSender(Thread):
 
 def get_session(apikey):
     session = requests.Session()
-    session.headers.update({'Authorization': f'Bearer: {apikey}'})
+    # Bodies are pre-encoded with orjson, so the JSON content type is set once
+    # here rather than on each request
+    session.headers.update({'Authorization': f'Bearer {apikey}',
+                            'Content-Type': 'application/json'})
     retries = Retry(backoff_factor=1, status_forcelist=[502, 503, 504])
-    session.mount('http://', HTTPAdapter(max_retries=retries))
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    # The client talks to a single collector host; share one small keep-alive
+    # pool between schemes. The connection opened by establish_connection is
+    # reused by the HTTPSender.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
     return session
 
 
@@ -188,7 +289,7 @@ def establish_connection(session: requests.Session, host: str, sensor_name: str,
     uri = urljoin(host, f'/sensor/{sensor_type}/{sensor_name}')
     try:
         response = session.get(uri)
-        data = response.json()
+        data = orjson.loads(response.content)
     except ConnectionError:
         LOG.exception(f'Unable to connect to collector endpoint {uri}')
         return None
@@ -206,8 +307,8 @@ def establish_connection(session: requests.Session, host: str, sensor_name: str,
         return sid
     else:
         try:
-            response = session.put(uri, json={})
-            data = response.json()
+            response = session.put(uri, data=b'{}')
+            data = orjson.loads(response.content)
         except ConnectionError:
             return None
         except JSONDecodeError:
@@ -221,7 +322,7 @@ def run_client(device: str, apikey: str, host: str, sensor_name: str = None,
                sensor_type: str = None, **cfg):
     if 'meterini' in cfg:
         meter_cfg = read_config(cfg['meterini'])
-        LOG.debug(f'Read Meter.ini configuration: {meter_cfg}')
+        LOG.debug('Read Meter.ini configuration: %s', meter_cfg)
     else:
         meter_cfg = {}
 
@@ -231,9 +332,10 @@ def run_client(device: str, apikey: str, host: str, sensor_name: str = None,
         LOG.info("Establishing HTTP connection")
         sensor_id = establish_connection(session, host, sensor_name, sensor_type)
 
-    listener = SerialListener(device)
-    http_sender = HTTPSender(listener.collector, listener.exit_sig, session,
-                             host, sensor_id, sensor_type, meter_cfg)
+    listener = SerialListener(device, get_extractor(sensor_type, HTTPSender.fields))
+    http_sender = HTTPSender(listener.collector, listener.exit_sig,
+                             listener.batch_ready, session, host, sensor_id,
+                             sensor_type, meter_cfg)
 
     try:
         http_sender.start()
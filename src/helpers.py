@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import configparser
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timezone
+from functools import lru_cache, partial
 from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Union
+from typing import Callable, List, Dict, Tuple, Union
 
 __all__ = ['decode_bytearr', 'get_extractor', 'read_config']
 LOG = logging.getLogger(__name__)
@@ -18,17 +20,37 @@ _marine_fieldmap = ['header', 'gravity', 'long_acc', 'cross_acc', 'beam',
 _airborne_fieldmap = ['header', 'gravity', 'long_acc', 'cross_acc', 'beam',
                       's_temperature', 'status', 'pressure', 'e_temperature',
                       'latitude', 'longitude']
+# Expected delimiter counts, checked before splitting a line (airborne lines
+# have trailing GPS week/seconds columns not included in the fieldmap)
+_MARINE_COMMAS = len(_marine_fieldmap) - 1
+_AIRBORNE_COMMAS = len(_airborne_fieldmap) + 1
 
-ILLEGAL_CHARS = list(chain(range(0, 32), [255, 256]))
+ILLEGAL_CHARS = frozenset(chain(range(0, 32), [255, 256]))
+# Deletion table for bytes.translate (256 can never occur in a byte string)
+_DELETE_BYTES = bytes(sorted(c for c in ILLEGAL_CHARS if c < 256))
+
+
+@lru_cache(maxsize=2048)
+def _parse_marine_time(meter_time: str) -> float:
+    """Parse a YYYYMMDDHHMMSS string (UTC) to a unix timestamp
+
+    Results are cached as consecutive 10hz samples share the same timestamp.
+    datetime validates the full date/time, raising ValueError for invalid
+    values (e.g. 30 Feb or second 60).
+    """
+    if len(meter_time) != 14 or not meter_time.isdigit():
+        raise ValueError(f'Invalid meter time: {meter_time}')
+    return datetime(int(meter_time[0:4]), int(meter_time[4:6]), int(meter_time[6:8]),
+                    int(meter_time[8:10]), int(meter_time[10:12]), int(meter_time[12:14]),
+                    tzinfo=timezone.utc).timestamp()
 
 
 def convert_marine_time(meter_time):
     """Convert a AT1M Marine datetime string to a unix timestamp"""
-    fmt = '%Y%m%d%H%M%S'
     try:
-        return datetime.strptime(meter_time, fmt).timestamp()
+        return _parse_marine_time(meter_time)
     except ValueError:
-        return datetime.utcnow().timestamp()
+        return time.time()
 
 
 def convert_gps_time(gpsweek, gpsweekseconds):
@@ -74,9 +96,12 @@ def decode_bytearr(bytearr, encoding='utf-8'):
     if isinstance(bytearr, str):
         return bytearr
     try:
-        raw = bytes([c for c in bytearr if c not in ILLEGAL_CHARS])
-        decoded = raw.decode(encoding, errors='ignore').strip('\r\n')
-    except AttributeError:
+        # bytes/bytearray translate directly; anything else is copied to bytes
+        if not isinstance(bytearr, (bytes, bytearray)):
+            bytearr = bytes(bytearr)
+        # CR/LF are in ILLEGAL_CHARS, so no separate line-ending strip is needed
+        decoded = bytearr.translate(None, _DELETE_BYTES).decode(encoding, errors='ignore')
+    except (AttributeError, TypeError):
         decoded = None
     return decoded
 
@@ -91,57 +116,106 @@ _field_casts = {
 }
 
 
-def _extract_airborne_fields(data: str, fields: List[str]):
+# Extraction plan: (column index, output field name, cast function)
+_Plan = Tuple[Tuple[int, str, Callable], ...]
+
+
+def _build_plan(fieldmap: List[str], fields: Tuple[str, ...]) -> _Plan:
+    """Pre-compute the columns to extract from a line for the requested fields"""
+    return tuple((i, field.lower(), _field_casts.get(field.lower(), int))
+                 for i, field in enumerate(fieldmap) if field.lower() in fields)
+
+
+def _extract_airborne_fields(data: str, plan: _Plan):
+    n_commas = data.count(',')
+    if n_commas != _AIRBORNE_COMMAS:
+        LOG.error('Data and field-map lengths do not match. %d != %d', n_commas + 1, len(_airborne_fieldmap))
+        return None
     extracted = {}
     data: List[str] = data.split(',')
     # GPS Week/seconds fields not included in fieldmap
-
-    if not (len(data) == (len(_airborne_fieldmap) + 2)):
-        LOG.error(f'Data and field-map lengths do not match. {len(data)} != {len(_airborne_fieldmap)}')
-        return None
     try:
-        gpssecond = float(data.pop())
-        gpsweek = int(data.pop())
+        gpssecond = float(data[-1])
+        gpsweek = int(data[-2])
         dt = convert_gps_time(gpsweek, gpssecond)
     except (ValueError, TypeError):
         return None
 
-    for i, field in enumerate(_airborne_fieldmap):
-        field = field.lower()
-        if field in fields:
-            try:
-                extracted[field] = _field_casts.get(field, int)(data[i])
-            except ValueError:
-                extracted[field] = data[i]
-            except IndexError:
-                return None
+    for i, field, cast in plan:
+        try:
+            extracted[field] = cast(data[i])
+        except ValueError:
+            extracted[field] = data[i]
     extracted['datetime'] = dt
     return extracted
 
 
-def _extract_marine_fields(data: str, fields: List[str]):
+def _extract_marine_fields(data: str, plan: _Plan):
     """Extract fields from raw ASCII data line, and perform type casts"""
+    if data.count(',') != _MARINE_COMMAS:
+        LOG.error("Data and field-map lengths do not match.\nData: %s", data)
+        return None
     extracted = {}
     data = data.split(',')
-    if not len(data) == len(_marine_fieldmap):
-        LOG.error(f"Data and field-map lengths do not match.\nData: {data}")
-        return None
-    for i, field in enumerate(_marine_fieldmap):
-        if field.lower() in fields:
-            try:
-                extracted[field] = _field_casts.get(field.lower(), int)(data[i])
-            except ValueError:
-                extracted[field] = data[i]
-            except IndexError:
-                return None
+    for i, field, cast in plan:
+        try:
+            extracted[field] = cast(data[i])
+        except ValueError:
+            extracted[field] = data[i]
     return extracted
 
 
-def get_extractor(sensor_type: str):
-    if sensor_type.upper() == 'AT1M':
-        return _extract_marine_fields
+def _compile_extractor(n_columns: int, plan: _Plan, fallback: Callable,
+                       gps_time: bool = False) -> Callable[[str], Union[dict, None]]:
+    """Generate an extractor specialized for a fixed extraction plan
+
+    The generated function builds the record in a single dict expression. Any
+    line which fails the fast path (column count or cast failure) is passed to
+    fallback, which handles per-field cast failures and error logging.
+    If gps_time is True the last two columns (GPS week, seconds) are converted
+    to the 'datetime' field.
+    """
+    namespace = {'_fallback': fallback, '_gps_time': convert_gps_time}
+    items = []
+    for i, field, cast in plan:
+        namespace[f'_cast{i}'] = cast
+        items.append(f'{field!r}: _cast{i}(parts[{i}])')
+    if gps_time:
+        items.append(f"'datetime': _gps_time(int(parts[{n_columns - 2}]), "
+                     f"float(parts[{n_columns - 1}]))")
+
+    src = (f"def _extract(data):\n"
+           f"    if data.count(',') != {n_columns - 1}:\n"
+           f"        return _fallback(data)\n"
+           f"    parts = data.split(',')\n"
+           f"    try:\n"
+           f"        return {{{', '.join(items)}}}\n"
+           f"    except ValueError:\n"
+           f"        return _fallback(data)\n")
+    exec(src, namespace)
+    return namespace['_extract']
+
+
+@lru_cache(maxsize=8)
+def _get_extractor(sensor_type: str, fields: Tuple[str, ...]):
+    if sensor_type == 'AT1M':
+        plan = _build_plan(_marine_fieldmap, fields)
+        return _compile_extractor(_MARINE_COMMAS + 1, plan,
+                                  partial(_extract_marine_fields, plan=plan))
     else:
-        return _extract_airborne_fields
+        plan = _build_plan(_airborne_fieldmap, fields)
+        return _compile_extractor(_AIRBORNE_COMMAS + 1, plan,
+                                  partial(_extract_airborne_fields, plan=plan),
+                                  gps_time=True)
+
+
+def get_extractor(sensor_type: str, fields: List[str]) -> Callable[[str], Union[dict, None]]:
+    """Return an extractor function for sensor_type, which extracts the
+    requested fields from a raw ASCII data line
+
+    Extractors are cached per (sensor_type, fields) combination.
+    """
+    return _get_extractor(sensor_type.upper(), tuple(fields))
 
 
 sensor_fields = ['g0', 'GravCal', 'LongCal', 'CrossCal', 'LongOffset', 'CrossOffset', 'stempgain',
@@ -156,6 +230,7 @@ platform_fields = ['Cross_Damping', 'Cross_Periode', 'Cross_Lead', 'Cross_Gain',
                    'Long_Comp', 'Long_Phcomp', 'Long_sp', 'zerolong', 'zerocross', 'CrossSp', 'LongSp']
 
 valid_fields = set().union(sensor_fields, cc_fields, platform_fields)
+_valid_fields_lower = frozenset(map(str.lower, valid_fields))
 
 
 def read_config(path: Path) -> Dict[str, Union[str, int, float]]:
@@ -178,5 +253,5 @@ def read_config(path: Path) -> Dict[str, Union[str, int, float]]:
             return value
 
     merged = {**sensor_fld, **xcoupling_fld, **platform_fld}
-    return {k.lower(): safe_cast(v) for k, v in merged.items() if k.lower() in map(str.lower, valid_fields)}
+    return {k.lower(): safe_cast(v) for k, v in merged.items() if k.lower() in _valid_fields_lower}
 